@@ -5,9 +5,11 @@
 # =============================
 
 import os
+import time
+import threading
 import streamlit as st
 from dotenv import load_dotenv
-from rag import answer, retrieve
+from rag import answer_stream, index_version, llm_error_message, load_retriever, warm_llm
 
 # ---------- Streamlit page config ----------
 st.set_page_config(page_title="Partner Onboarding RAG", page_icon="🤝", layout="wide")
@@ -16,6 +18,55 @@ st.title("🤝 Partner Onboarding Bot (RAG)")
 # ---------- Environment / options ----------
 load_dotenv()
 DEFAULT_TOP_K = int(os.getenv("TOP_K", "4"))
+ANSWER_CACHE_TTL = 3600  # seconds an answer is reused for an identical (question, Top-K, index)
+
+
+# ---------- Shared resources (once per server process, not per rerun) ----------
+@st.cache_resource(show_spinner="Loading embeddings and vector store…")
+def _load_retriever():
+    load_retriever()
+
+
+@st.cache_resource
+def _warm_llm():
+    # Fire‑and‑forget: the model loads in the background while the page renders
+    threading.Thread(target=warm_llm, daemon=True).start()
+
+
+@st.cache_resource
+def _answer_cache():
+    """({(question, top_k, index version): (timestamp, answer, ctx)}, lock), shared across
+    sessions. Each session runs its script in its own thread, so every access takes the lock.
+    """
+    return {}, threading.Lock()
+
+
+def _recall_answer(key):
+    """Cached (timestamp, answer, ctx) for key if it is younger than the TTL, else None."""
+    cache, lock = _answer_cache()
+    with lock:
+        hit = cache.get(key)
+    if hit and time.time() - hit[0] < ANSWER_CACHE_TTL:
+        return hit
+    return None
+
+
+def _remember_answer(key, a, ctx):
+    """Cache an answer and drop expired entries so the cache stays bounded by the TTL."""
+    cache, lock = _answer_cache()
+    now = time.time()
+    with lock:
+        for old in [k for k, (ts, _, _) in cache.items() if now - ts >= ANSWER_CACHE_TTL]:
+            del cache[old]
+        cache[key] = (now, a, ctx)
+
+
+_warm_llm()
+try:
+    _load_retriever()
+except Exception as e:
+    # Not cached on failure, so the next rerun tries again; questions report the error meanwhile
+    st.warning(f"Vector store not ready ({e}). Check `CHROMA_HOST` or run `python ingest.py`.")
 
 with st.sidebar:
     st.header("Settings")
@@ -30,13 +81,24 @@ st.write(
     "Ask anything about your **partner program**: MDF, enablement assets, deal registration SLAs, onboarding steps, etc."
 )
 
+
+def show_context(ctx):
+    """Show retrieved chunks for transparency/debugging."""
+    with st.expander("Show retrieved context excerpts"):
+        for i, (doc, meta) in enumerate(ctx, start=1):
+            st.markdown(f"**#{i} — {meta.get('source','unknown')} (chunk {meta.get('chunk')})**")
+            st.code(doc)
+
+
 # Previous conversation (optional for nicer UX)
 if "history" not in st.session_state:
-    st.session_state.history = []  # list of (role, message)
+    st.session_state.history = []  # list of (role, message, context pairs)
 
-for role, msg in st.session_state.history:
+for role, msg, ctx in st.session_state.history:
     with st.chat_message(role):
         st.markdown(msg)
+        if ctx:
+            show_context(ctx)
 
 # ---------- Chat input ----------
 q = st.chat_input("Ask about MDF, enablement, deal reg…")
@@ -45,21 +107,43 @@ if q:
         st.markdown(q)
 
     with st.chat_message("assistant"):
-        with st.spinner("Thinking with your docs…"):
-            a = answer(q, top_k)
+        # Keyed on the index version too, so a re‑ingest invalidates cached answers
+        try:
+            version = index_version()
+        except Exception:
+            version = None  # store unreachable: answer_stream below reports it
+        key = (q, top_k, version)
+        cached = _recall_answer(key) if version else None
+        if cached:
+            # Identical question asked recently: skip retrieval and the LLM entirely
+            _, a, ctx = cached
             st.markdown(a)
+        else:
+            with st.spinner("Thinking with your docs…"):
+                try:
+                    pieces, ctx = answer_stream(q, top_k)
+                except Exception as e:
+                    # Vector store unreachable: show the error, never cache it
+                    pieces, ctx = iter([
+                        "Retrieval failed. Check the vector store (`python ingest.py`, `CHROMA_HOST`).\n\n"
+                        f"Error: {e}"
+                    ]), []
+                try:
+                    # Render tokens as they arrive instead of waiting for the full answer
+                    a = st.write_stream(pieces)
+                    if ctx and version:
+                        _remember_answer(key, a, ctx)
+                except Exception as e:
+                    a = llm_error_message(e)
+                    st.markdown(a)
 
-        # Optional: show retrieved chunks for transparency/debugging
-        with st.expander("Show retrieved context excerpts"):
-            ctx = retrieve(q, k=top_k)
-            for i, (doc, meta) in enumerate(ctx, start=1):
-                st.markdown(f"**#{i} — {meta.get('source','unknown')} (chunk {meta.get('chunk')})**")
-                st.code(doc)
+        # Reuses the context the answer was grounded on (no second retrieval)
+        show_context(ctx)
 
     # save to history (so it persists on rerun)
-    st.session_state.history.append(("user", q))
-    st.session_state.history.append(("assistant", a))
+    st.session_state.history.append(("user", q, []))
+    st.session_state.history.append(("assistant", a, ctx))
 
 st.caption(
-    "Powered by local embeddings (all-MiniLM-L6-v2) + your docs in ChromaDB + a small local LLM via Ollama (phi3 by default)."
+    "Powered by local embeddings (all-MiniLM-L6-v2) + your docs in ChromaDB + a small local LLM via Ollama (granite3.3:8b by default)."
 )
@@ -0,0 +1,98 @@
+# =============================
+# File: embeddings.py
+# Purpose: The sentence encoder shared by ingest.py (chunks) and rag.py (queries).
+#          EMBED_BACKEND=torch (default): sentence-transformers on CUDA / MPS / CPU.
+#          EMBED_BACKEND=onnx:  ONNX Runtime on CPU, typically an int8-quantized export
+#                               (2-4x faster on CPU-only boxes). See readme for export steps.
+# Notes:   Both sides must use the same backend; re-ingest after switching it.
+# =============================
+
+import os
+import glob
+import numpy as np
+from typing import List
+from dotenv import load_dotenv
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+# A small, fast, free embedding model — great default for local work
+EMBED_MODEL = "all-MiniLM-L6-v2"
+DEFAULT_ONNX_MODEL_DIR = "onnx_minilm_int8"
+
+
+def _pick_device() -> str:
+    """Prefer CUDA, then Apple MPS, otherwise CPU."""
+    import torch
+
+    if torch.cuda.is_available():
+        return "cuda"
+    if getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+class ONNXMiniLM(EmbeddingFunction):
+    """MiniLM exported to ONNX, run with onnxruntime's CPU provider.
+    Mean‑pools token states and L2‑normalizes, like the sentence‑transformers pipeline.
+    Exposes the subset of SentenceTransformer.encode() this project uses, and can also
+    be passed to Chroma directly as an embedding_function.
+    """
+
+    def __init__(self, model_dir: str, max_length: int = 256):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        onnx_files = sorted(glob.glob(os.path.join(model_dir, "*.onnx")))
+        if not onnx_files:
+            raise FileNotFoundError(f"No .onnx model found in {model_dir} (see readme: ONNX embeddings)")
+        # optimum's quantizer writes model_quantized.onnx next to (or instead of) model.onnx
+        quantized = [f for f in onnx_files if "quantized" in os.path.basename(f)]
+        self._session = ort.InferenceSession((quantized or onnx_files)[0], providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self._session.get_inputs()}
+        try:
+            self._tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        except (OSError, ValueError):
+            # The quantize step does not always copy tokenizer files
+            self._tokenizer = AutoTokenizer.from_pretrained(f"sentence-transformers/{EMBED_MODEL}")
+        self._max_length = max_length
+
+    def encode(
+        self,
+        texts: List[str],
+        batch_size: int = 32,
+        normalize_embeddings: bool = True,
+        convert_to_numpy: bool = True,
+        show_progress_bar: bool = False,
+    ) -> np.ndarray:
+        out = []
+        for start in range(0, len(texts), batch_size):
+            tok = self._tokenizer(
+                texts[start : start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self._max_length,
+                return_tensors="np",
+            )
+            feeds = {k: v.astype(np.int64) for k, v in tok.items() if k in self._input_names}
+            hidden = self._session.run(None, feeds)[0]  # (batch, tokens, dim)
+            mask = tok["attention_mask"][..., None].astype(hidden.dtype)
+            vecs = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                vecs = vecs / np.clip(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12, None)
+            out.append(vecs.astype(np.float32))
+        if not out:
+            return np.zeros((0, 384), dtype=np.float32)  # MiniLM dimension
+        return np.concatenate(out)
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return self.encode(list(input)).tolist()
+
+
+def load_embedder():
+    """Build the encoder selected by EMBED_BACKEND (callers cache it per process)."""
+    load_dotenv()
+    if os.getenv("EMBED_BACKEND", "torch").strip().lower() == "onnx":
+        return ONNXMiniLM(os.getenv("ONNX_MODEL_DIR", DEFAULT_ONNX_MODEL_DIR))
+    # Imported lazily: sentence-transformers pulls in torch
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(EMBED_MODEL, device=_pick_device())
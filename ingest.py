@@ -7,48 +7,88 @@
 # =============================
 
 import os
-import glob
-from typing import List, Tuple
+import json
+import re
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
 from dotenv import load_dotenv
 from pypdf import PdfReader
+import fitz  # PyMuPDF
+import xxhash
 import chromadb
-from chromadb.utils import embedding_functions
+from tqdm import tqdm
+from embeddings import load_embedder
+from vectorstore import COLLECTION_NAME, chroma_client, is_missing_collection
+
+# ---------- Input files ----------
+SUPPORTED_EXTS = (".txt", ".pdf")
 
 # ---------- Chunking parameters ----------
 # Chunking splits long documents into overlapping slices so the retriever can
 # fetch the most relevant passages for a question. You can tweak sizes later.
 CHUNK_SIZE = 800       # characters per chunk (≈ 150–200 words)
 CHUNK_OVERLAP = 120    # overlap between consecutive chunks (keeps context continuity)
+_NON_WS = re.compile(r"\S")
+_CR_TABLE = str.maketrans("", "", "\r")
+
+# ---------- Embedding parameters ----------
+# Chunks are embedded here (not inside Chroma) so the encoder runs with large,
+# uniform batches on the best available device.
+EMBED_BATCH_SIZE = 256
+# Rows per collection.add call; large single writes are slow and memory‑hungry in Chroma.
+ADD_BATCH_SIZE = 1500
+
+# ---------- Vector index (HNSW) parameters ----------
+# Tuned for small corpora (<~10k chunks): a generous build‑time graph lets queries
+# use a low search_ef with no practical recall loss. Embeddings are L2‑normalized,
+# so cosine is the natural space. Index params are fixed when the collection is
+# created; build_collection() rebuilds it if space/M/construction_ef change.
+HNSW_SPACE = "cosine"
+HNSW_CONSTRUCTION_EF = 200
+HNSW_M = 32
+DEFAULT_SEARCH_EF = 32
 
+# Sidecar manifest: {path: {"mtime_ns", "size", "ids"}} from the last run, used to
+# skip parsing and embedding files that have not changed.
+MANIFEST_PATH = os.path.join("data", "db", "manifest.json")
 
-def chunk_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+
+def chunk_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> Iterator[str]:
     """Greedy fixed-size chunking with overlap.
     Simple, reliable, and fast for MVPs. You can upgrade to sentence-aware
-    chunking later if needed.
+    chunking later if needed. Yields chunks lazily and skips whitespace-only
+    windows without copying them.
     """
-    chunks = []
-    i = 0
-    n = len(text)
-    while i < n:
-        chunk = text[i : i + size]
-        if chunk.strip():
-            chunks.append(chunk)
-        i += max(1, size - overlap)
-    return chunks
+    step = max(1, size - overlap)
+    for i in range(0, len(text), step):
+        if _NON_WS.search(text, i, i + size):
+            yield text[i : i + size]
 
 
 def read_txt(path: str) -> str:
     """Read a UTF‑8 (or best‑effort) text file and normalize whitespace."""
     with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        txt = f.read()
+        txt = f.read().translate(_CR_TABLE)
     # Normalize pesky whitespace so retrieval and display are cleaner
-    return "\n".join(line.strip() for line in txt.replace("\r", "").split("\n"))
+    return "\n".join(map(str.strip, txt.split("\n")))
 
 
 def read_pdf(path: str) -> str:
-    """Extract text from a PDF via PyPDF. Not all PDFs contain extractable text.
+    """Extract text from a PDF via PyMuPDF (C-backed, much faster than pure-Python
+    parsers). Falls back to PyPDF for encrypted or malformed files PyMuPDF rejects.
+    Not all PDFs contain extractable text.
     For image‑only PDFs, consider OCR (e.g., Tesseract) as a future enhancement.
     """
+    try:
+        doc = fitz.open(path)
+        try:
+            return "\n".join(page.get_text("text") for page in doc)
+        finally:
+            doc.close()
+    except Exception:
+        pass
+
     reader = PdfReader(path)
     out_lines = []
     for page in reader.pages:
@@ -58,12 +98,31 @@ def read_pdf(path: str) -> str:
 
 
 def collect_files(root: str) -> List[str]:
-    """Recursively list files from root. Supports .txt and .pdf by default."""
-    patterns = ["**/*.txt", "**/*.pdf"]
-    files = []
-    for p in patterns:
-        files.extend(glob.glob(os.path.join(root, p), recursive=True))
-    return [f for f in files if os.path.isfile(f)]
+    """Recursively list files from root. Supports .txt and .pdf by default.
+    Uses os.scandir, whose entries carry their file type, so no extra stat per entry.
+    """
+    stack, files, seen = [root], [], set()
+    while stack:
+        folder = stack.pop()
+        # Symlinked folders are followed (as glob did); realpath guards against loops
+        real = os.path.realpath(folder)
+        if real in seen:
+            continue
+        seen.add(real)
+        try:
+            with os.scandir(folder) as it:
+                entries = list(it)
+        except OSError as e:
+            print(f"[skip] {folder}: {e}")
+            continue
+        for entry in entries:
+            if entry.name.startswith("."):  # hidden files/dirs, as glob skipped them
+                continue
+            if entry.is_dir():
+                stack.append(entry.path)
+            elif entry.is_file() and entry.name.lower().endswith(SUPPORTED_EXTS):
+                files.append(entry.path)
+    return files
 
 
 def ensure_sample_copy():
@@ -77,49 +136,187 @@ def ensure_sample_copy():
         shutil.copy(src, dst)
 
 
+@functools.lru_cache(maxsize=1)
+def get_embedder():
+    """Load the sentence encoder once per process (see embeddings.py for backends)."""
+    return load_embedder()
+
+
 def build_collection() -> chromadb.api.models.Collection.Collection:
-    """Open (or create) the persistent Chroma collection with a sentence‑transformer embedder."""
-    # Persistent DB path for Chroma (lives on disk under data/db)
-    client = chromadb.PersistentClient(path=os.path.join("data", "db"))
-    # A small, fast, free embedding model — great default for local work
-    embedder = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="all-MiniLM-L6-v2"
-    )
-    # Using a stable collection name lets the app find it consistently
-    collection = client.get_or_create_collection(
-        name="partner_docs", embedding_function=embedder
+    """Open (or create) the persistent Chroma collection.
+    Embeddings are computed by get_embedder() and passed in explicitly, so the
+    collection carries no embedding function of its own.
+    """
+    client = chroma_client()
+    # Graph‑shape params are baked into the index; search_ef is only applied at creation.
+    build_params = {
+        "hnsw:space": HNSW_SPACE,
+        "hnsw:construction_ef": HNSW_CONSTRUCTION_EF,
+        "hnsw:M": HNSW_M,
+    }
+    search_ef = int(os.getenv("SEARCH_EF", DEFAULT_SEARCH_EF))
+    try:
+        collection = client.get_collection(name=COLLECTION_NAME, embedding_function=None)
+    except Exception as e:
+        if not is_missing_collection(e):
+            raise
+        collection = None
+    if collection is not None:
+        current = collection.metadata or {}
+        if all(current.get(k) == v for k, v in build_params.items()):
+            if current.get("hnsw:search_ef") != search_ef:
+                print(f"[note] SEARCH_EF={search_ef} only applies when {COLLECTION_NAME} is created "
+                      f"(current: {current.get('hnsw:search_ef')}); delete the collection to change it.")
+            return collection
+        print(f"[rebuild] HNSW settings changed; recreating collection {COLLECTION_NAME}")
+        client.delete_collection(name=COLLECTION_NAME)
+    return client.create_collection(
+        name=COLLECTION_NAME,
+        metadata={**build_params, "hnsw:search_ef": search_ef},
+        embedding_function=None,
     )
-    return collection
 
 
-def index_files(files: List[str]) -> Tuple[int, int]:
-    """Read, chunk, and upsert files into Chroma. Returns (#files, #chunks)."""
-    collection = build_collection()
+def chunk_id(path: str, text: str) -> str:
+    """Deterministic, content‑addressed chunk id (xxh3 of path + chunk text).
+    Unchanged chunks keep their id across runs, so re‑ingest only embeds what changed;
+    the path keeps identical passages in different files apart.
+    """
+    return xxhash.xxh3_64_hexdigest(f"{path}\0{text}".encode("utf-8"))
 
-    # Optional: clear existing entries to avoid duplicates on re‑ingest.
-    # Comment this out if you prefer incremental adds.
+
+def _load_and_chunk(fpath: str) -> Optional[List[Tuple[str, Dict, str]]]:
+    """Read and chunk one file into (text, metadata, id) triples; None if it can't be read.
+    Runs in a worker process, so it must stay importable and free of the embedder.
+    """
+    ext = os.path.splitext(fpath)[1].lower()
     try:
-        collection.delete(where={})
-    except Exception:
-        pass
+        raw = read_pdf(fpath) if ext == ".pdf" else read_txt(fpath)
+    except Exception as e:
+        print(f"[skip] {fpath}: {e}")
+        return None
+    name = os.path.basename(fpath)
+    return [
+        (ch, {"source": name, "path": fpath, "chunk": j}, chunk_id(fpath, ch))
+        for j, ch in enumerate(chunk_text(raw))
+    ]
 
-    texts, metadatas, ids = [], [], []
 
+def _load_manifest() -> Dict[str, Dict]:
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(manifest: Dict[str, Dict]) -> None:
+    # Write‑then‑rename so an interrupted run never leaves a truncated manifest
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    tmp = MANIFEST_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, MANIFEST_PATH)
+
+
+def _stored_ids(collection, ids: List[str]) -> set:
+    """The subset of ids already present in the collection (looked up in batches)."""
+    found = set()
+    for start in range(0, len(ids), ADD_BATCH_SIZE):
+        found.update(collection.get(ids=ids[start : start + ADD_BATCH_SIZE], include=[])["ids"])
+    return found
+
+
+def index_files(files: List[str]) -> Tuple[int, int]:
+    """Read, chunk, and upsert files into Chroma. Returns (#files, #chunks).
+    Files whose mtime and size match the manifest, and whose chunks are all still
+    stored, are skipped without being parsed.
+    """
+    collection = build_collection()
+    old_manifest = _load_manifest()
+    manifest: Dict[str, Dict] = {}
+
+    stats = {}
     for fpath in files:
-        ext = os.path.splitext(fpath)[1].lower()
         try:
-            raw = read_pdf(fpath) if ext == ".pdf" else read_txt(fpath)
-        except Exception as e:
+            st = os.stat(fpath)
+        except OSError as e:  # removed or unreadable since collect_files()
             print(f"[skip] {fpath}: {e}")
             continue
-        for j, ch in enumerate(chunk_text(raw)):
-            texts.append(ch)
-            metadatas.append({"source": os.path.basename(fpath), "path": fpath, "chunk": j})
-            ids.append(f"{os.path.basename(fpath)}-{j}")
+        stats[fpath] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+    unchanged = {
+        f: old_manifest[f]["ids"]
+        for f, st in stats.items()
+        if f in old_manifest
+        and all(old_manifest[f].get(key) == val for key, val in st.items())
+    }
+    stored = _stored_ids(collection, [cid for f_ids in unchanged.values() for cid in f_ids])
+    for fpath, f_ids in unchanged.items():
+        if all(cid in stored for cid in f_ids):
+            manifest[fpath] = {**stats[fpath], "ids": f_ids}
+    to_process = [f for f in stats if f not in manifest]
+    if manifest:
+        print(f"[skip] {len(manifest)} unchanged file(s)")
+
+    texts, metadatas, ids = [], [], []
+
+    # Parsing is CPU‑bound and independent per file, so fan it out across cores.
+    # The embedder stays in this process (avoids loading it per worker / CUDA fork issues).
+    if to_process:
+        with ProcessPoolExecutor(max_workers=min(len(to_process), os.cpu_count() or 1)) as ex:
+            results = ex.map(_load_and_chunk, to_process, chunksize=4)
+            for fpath, triples in zip(to_process, results):
+                if triples is None:  # unreadable: leave it out so the next run retries it
+                    continue
+                f_ids, seen = [], set()
+                for text, meta, cid in triples:
+                    if cid in seen:  # repeated passage within one file
+                        continue
+                    seen.add(cid)
+                    f_ids.append(cid)
+                    texts.append(text)
+                    metadatas.append(meta)
+                    ids.append(cid)
+                # Recorded even with no chunks (empty/image‑only PDFs) so it isn't re‑parsed
+                manifest[fpath] = {**stats[fpath], "ids": f_ids}
+
+    # Drop chunks that no longer belong to any file (edited or removed files).
+    current = {cid for entry in manifest.values() for cid in entry["ids"]}
+    if old_manifest:
+        stale = {cid for entry in old_manifest.values() for cid in entry["ids"]} - current
+    else:
+        # No manifest (first run, or it was deleted): sweep everything untracked.
+        stale = set(collection.get(include=[])["ids"]) - current
+    stale = list(stale)
+    for start in range(0, len(stale), ADD_BATCH_SIZE):
+        collection.delete(ids=stale[start : start + ADD_BATCH_SIZE])
+
+    # Ids are content‑addressed, so chunks already stored are unchanged: embed only the rest.
+    stored = _stored_ids(collection, ids)
+    todo = [i for i, cid in enumerate(ids) if cid not in stored]
+
+    # Embed and write in bounded batches so peak memory stays flat on large corpora.
+    if todo:
+        embedder = get_embedder()
+        for start in tqdm(range(0, len(todo), ADD_BATCH_SIZE), desc="Indexing", unit="batch"):
+            batch = todo[start : start + ADD_BATCH_SIZE]
+            embeddings = embedder.encode(
+                [texts[i] for i in batch],
+                batch_size=EMBED_BATCH_SIZE,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+            )
+            collection.upsert(
+                ids=[ids[i] for i in batch],
+                embeddings=embeddings.tolist(),
+                documents=[texts[i] for i in batch],
+                metadatas=[metadatas[i] for i in batch],
+            )
 
-    if texts:
-        collection.add(documents=texts, metadatas=metadatas, ids=ids)
-    return len(files), len(texts)
+    _save_manifest(manifest)
+    return len(files), len(current)
 
 
 if __name__ == "__main__":
@@ -136,4 +333,4 @@ if __name__ == "__main__":
     if n_files == 0:
         print("No documents found. Drop TXT/PDF files under data/docs/ and re‑run: python ingest.py")
     else:
-        print(f"Indexed {n_chunks} chunks from {n_files} files into Chroma (collection: partner_docs).")
+        print(f"Indexed {n_chunks} chunks from {n_files} files into Chroma (collection: {COLLECTION_NAME}).")
@@ -2,7 +2,8 @@
 # File: rag.py
 # Purpose: Retrieval + Generation helpers.
 #          1) retrieve(): nearest‑neighbor search over your vector store
-#          2) answer():   prompt a small local LLM (Ollama) using retrieved context
+#          2) answer():   prompt a small local LLM (Ollama, or vLLM via LLM_BACKEND=vllm)
+#                         using retrieved context
 # Run:     imported by app.py (you can also test in a Python REPL)
 # =============================
 
@@ -32,11 +33,15 @@
 
 
 import os
+import re
+import json
+import time
+import functools
 import requests
-import chromadb
-from chromadb.utils import embedding_functions
 from dotenv import load_dotenv
-from typing import List, Dict, Tuple
+from embeddings import load_embedder
+from vectorstore import COLLECTION_NAME, chroma_client, is_missing_collection
+from typing import Dict, Iterator, List, Optional, Tuple
 
 # System instruction keeps responses concise and grounded in supplied context.
 SYSTEM_PROMPT = (
@@ -46,63 +51,378 @@ SYSTEM_PROMPT = (
     " Be concise and use bullet points. Include a short 'Sources' list with file names."
 )
 
+# Session‑invariant instructions; kept ahead of the context in every prompt (see _build_prompt).
+ANSWER_FORMAT = "Answer format: bullets. Then add a 'Sources' list with the file names only."
 
+# Multi‑query retrieval (MULTI_QUERY=1): the LLM paraphrases the question and all
+# phrasings are retrieved in one batched query, which improves recall on terse or
+# jargon‑heavy questions at the cost of one extra (short) LLM call.
+REWRITE_PROMPT = (
+    "You rewrite search queries for a Partner Program documentation search."
+    " Rephrase the user's question {n} different ways, using synonyms and spelling out acronyms."
+    " Return one rewrite per line, with no numbering and no other text."
+)
+DEFAULT_MULTI_QUERY_N = 3
+
+# Budget for retrieved context in the prompt (override with MAX_CTX_TOKENS). Prefill
+# cost grows with prompt length, so a tight budget directly lowers time‑to‑first‑token.
+# Tokens are estimated as ~4 characters each, which is close enough for English text.
+DEFAULT_MAX_CTX_TOKENS = 1500
+CHARS_PER_TOKEN = 4
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+# Default generation models (override with OLLAMA_MODEL / VLLM_MODEL).
+# Ollama's library tag is already a 4‑bit Q4_K_M build (~5GB), which keeps decode fast
+# on modest GPUs; pull an `-fp16`/`-q8_0` variant instead when quality matters more.
+DEFAULT_OLLAMA_MODEL = "granite3.3:8b"
+DEFAULT_VLLM_MODEL = "ibm-granite/granite-3.3-8b-instruct"
+
+# Ollama unloads idle models after a few minutes; keep it resident between questions
+# (override with OLLAMA_KEEP_ALIVE). Context window and answer length are capped so a
+# runaway generation can't stall the UI.
+DEFAULT_KEEP_ALIVE = "30m"
+NUM_CTX = 4096
+MAX_NEW_TOKENS = 512
+
+# Upper bound on how long a memoized retrieval is reused (edits that keep the chunk
+# count unchanged are picked up after at most this long).
+RETRIEVE_CACHE_TTL = 300  # seconds
+
+
+@functools.lru_cache(maxsize=1)
+def _get_embedder():
+    """Load the query encoder once per process (same backend as ingest.py)."""
+    return load_embedder()
+
+
+@functools.lru_cache(maxsize=1)
 def _get_collection():
-    """Open the same Chroma collection created by ingest.py."""
-    client = chromadb.PersistentClient(path=os.path.join("data", "db"))
-    embedder = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="all-MiniLM-L6-v2"
-    )
-    return client.get_or_create_collection("partner_docs", embedding_function=embedder)
+    """Open the Chroma collection created by ingest.py (once per process).
+    Never creates it: ingest.py owns the index settings. Raises if nothing was ingested yet.
+    """
+    return chroma_client().get_collection(COLLECTION_NAME, embedding_function=None)
 
 
-def retrieve(query: str, k: int = 4) -> List[Tuple[str, Dict]]:
-    """Return top‑k (document_text, metadata) pairs for a user query."""
-    coll = _get_collection()
-    res = coll.query(query_texts=[query], n_results=max(1, k))
+def load_retriever() -> None:
+    """Eagerly load the query encoder and Chroma collection (both cached per process)."""
+    _get_embedder()
+    try:
+        _get_collection()
+    except Exception as e:
+        if not is_missing_collection(e):  # before the first ingest there is nothing to open
+            raise
+
+
+def _with_collection(fn):
+    """Call fn(collection). If ingest recreated the collection since it was opened
+    (the cached handle then points at a deleted id), reopen it once and retry.
+    """
+    try:
+        return fn(_get_collection())
+    except Exception as e:
+        if not is_missing_collection(e):
+            raise
+    _get_collection.cache_clear()
+    return fn(_get_collection())
+
+
+def _index_version(coll) -> Tuple[str, int]:
+    """(collection id, chunk count): changes when ingest adds/removes chunks or rebuilds."""
+    return str(coll.id), coll.count()
+
+
+def index_version() -> Optional[Tuple[str, int]]:
+    """Current (collection id, chunk count), or None before the first ingest.
+    Lets callers key their own caches on the state of the index.
+    """
+    try:
+        return _with_collection(_index_version)
+    except Exception as e:
+        if is_missing_collection(e):
+            return None
+        raise
+
+
+@functools.lru_cache(maxsize=1024)
+def _encode(query: str) -> Tuple[float, ...]:
+    """Normalized query embedding, memoized (tuples are hashable and immutable)."""
+    vec = _get_embedder().encode([query], normalize_embeddings=True, convert_to_numpy=True)[0]
+    return tuple(vec.tolist())
+
+
+@functools.lru_cache(maxsize=256)
+def _retrieve_cached(version: Tuple[str, int], ttl_bucket: int, query: str, k: int) -> Tuple[Tuple[str, Dict], ...]:
+    # version and ttl_bucket only partition the cache; see retrieve()
+    res = _get_collection().query(query_embeddings=[list(_encode(query))], n_results=max(1, k))
     docs = res.get("documents", [[]])[0]
     metas = res.get("metadatas", [[]])[0]
-    return list(zip(docs, metas))
+    return tuple(zip(docs, metas))
+
+
+def retrieve(query: str, k: int = 4) -> List[Tuple[str, Dict]]:
+    """Return top‑k (document_text, metadata) pairs for a user query.
+    Results are memoized per (query, k) until the collection changes (new id or chunk
+    count) and for at most RETRIEVE_CACHE_TTL seconds, so re‑ingests show up without
+    restarting the app.
+    """
+    def run(coll):
+        bucket = int(time.monotonic() // RETRIEVE_CACHE_TTL)
+        return _retrieve_cached(_index_version(coll), bucket, query, k)
+
+    try:
+        return list(_with_collection(run))
+    except Exception as e:
+        if is_missing_collection(e):  # nothing ingested yet
+            return []
+        raise
+
+
+def retrieve_multi(queries: List[str], k: int = 4) -> List[Tuple[str, Dict]]:
+    """Top‑k (document_text, metadata) pairs across several phrasings of one question.
+    All queries are encoded and searched in a single batch; hits are deduplicated by
+    chunk id and ranked by their best (smallest) distance.
+    """
+    vecs = _get_embedder().encode(
+        queries, batch_size=len(queries), normalize_embeddings=True, convert_to_numpy=True
+    ).tolist()
+    try:
+        res = _with_collection(lambda coll: coll.query(query_embeddings=vecs, n_results=max(1, k)))
+    except Exception as e:
+        if is_missing_collection(e):  # nothing ingested yet
+            return []
+        raise
+    best: Dict[str, Tuple[float, str, Dict]] = {}
+    for ids, docs, metas, dists in zip(res["ids"], res["documents"], res["metadatas"], res["distances"]):
+        for cid, doc, meta, dist in zip(ids, docs, metas, dists):
+            if cid not in best or dist < best[cid][0]:
+                best[cid] = (dist, doc, meta)
+    ranked = sorted(best.values(), key=lambda hit: hit[0])[:k]
+    return [(doc, meta) for _, doc, meta in ranked]
+
+
+def _ollama_payload(prompt: str, model: str, stream: bool) -> Dict:
+    return {
+        "model": model,
+        "prompt": prompt,
+        "stream": stream,
+        "keep_alive": os.getenv("OLLAMA_KEEP_ALIVE", DEFAULT_KEEP_ALIVE),
+        "options": {"num_ctx": NUM_CTX, "num_predict": MAX_NEW_TOKENS},
+    }
+
+
+def warm_llm(timeout: int = 60) -> None:
+    """Load the Ollama model now (empty prompt) so the first question skips the cold start.
+    No‑op for vLLM, which loads its model at server start. Failures are ignored.
+    """
+    if _llm_backend() == "vllm":
+        return
+    model = os.getenv("OLLAMA_MODEL", DEFAULT_OLLAMA_MODEL)
+    host = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+    # Same payload shape as real requests: Ollama reloads the runner when options
+    # such as num_ctx differ, which would undo the warm‑up on the first question.
+    try:
+        requests.post(f"{host}/api/generate", json=_ollama_payload("", model, False), timeout=timeout)
+    except requests.RequestException:
+        pass
 
 
 def _ollama_generate(prompt: str, model: str = None, host: str = None, timeout: int = 120) -> str:
     """Call a local Ollama model (default from .env). Returns plain text.
-    Make sure Ollama is running and a model is pulled, e.g.: `ollama pull phi3`.
+    Make sure Ollama is running and a model is pulled, e.g.: `ollama pull granite3.3:8b`.
     """
     load_dotenv()
-    model = model or os.getenv("OLLAMA_MODEL", "granite3.3:8b")
+    model = model or os.getenv("OLLAMA_MODEL", DEFAULT_OLLAMA_MODEL)
     host = host or os.getenv("OLLAMA_HOST", "http://localhost:11434")
     url = f"{host}/api/generate"
-    payload = {"model": model, "prompt": prompt, "stream": False}
-    r = requests.post(url, json=payload, timeout=timeout)
+    r = requests.post(url, json=_ollama_payload(prompt, model, False), timeout=timeout)
     r.raise_for_status()
     return r.json().get("response", "")
 
 
-def answer(query: str, top_k: int = 4) -> str:
-    """Compose a grounded answer using retrieved context and a strict system instruction.
-    Returns Markdown with a Sources section.
+def _ollama_stream(prompt: str, model: str = None, host: str = None, timeout: int = 120) -> Iterator[str]:
+    """Like _ollama_generate, but yields text fragments as Ollama produces them."""
+    load_dotenv()
+    model = model or os.getenv("OLLAMA_MODEL", DEFAULT_OLLAMA_MODEL)
+    host = host or os.getenv("OLLAMA_HOST", "http://localhost:11434")
+    url = f"{host}/api/generate"
+    with requests.post(url, json=_ollama_payload(prompt, model, True), stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise RuntimeError(chunk["error"])
+            yield chunk.get("response", "")
+
+
+def _vllm_payload(system: str, user: str, model: str, stream: bool) -> Dict:
+    return {
+        "model": model,
+        "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
+        "stream": stream,
+        "max_tokens": MAX_NEW_TOKENS,
+    }
+
+
+def _vllm_generate(system: str, user: str, model: str = None, host: str = None, timeout: int = 120) -> str:
+    """Call a vLLM server through its OpenAI‑compatible chat endpoint. Returns plain text.
+    vLLM batches concurrent requests, so it scales better than Ollama with several users.
     """
-    ctx_pairs = retrieve(query, k=top_k)
-    if not ctx_pairs:
-        return ("I couldn't retrieve any context. Please run `python ingest.py` after placing your documents "
-                "under `data/docs/`, then try again.")
+    load_dotenv()
+    model = model or os.getenv("VLLM_MODEL", DEFAULT_VLLM_MODEL)
+    host = host or os.getenv("VLLM_HOST", "http://localhost:8000")
+    url = f"{host}/v1/chat/completions"
+    r = requests.post(url, json=_vllm_payload(system, user, model, False), timeout=timeout)
+    r.raise_for_status()
+    return r.json()["choices"][0]["message"].get("content") or ""
+
+
+def _vllm_stream(system: str, user: str, model: str = None, host: str = None, timeout: int = 120) -> Iterator[str]:
+    """Like _vllm_generate, but yields text fragments from the server‑sent event stream."""
+    load_dotenv()
+    model = model or os.getenv("VLLM_MODEL", DEFAULT_VLLM_MODEL)
+    host = host or os.getenv("VLLM_HOST", "http://localhost:8000")
+    url = f"{host}/v1/chat/completions"
+    with requests.post(url, json=_vllm_payload(system, user, model, True), stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        for line in r.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            data = line[len(b"data:"):].strip()
+            if data == b"[DONE]":
+                break
+            chunk = json.loads(data)
+            if "error" in chunk:
+                raise RuntimeError(chunk["error"])
+            for choice in chunk.get("choices", []):
+                yield choice.get("delta", {}).get("content") or ""
+
+
+def _llm_backend() -> str:
+    """Which LLM server to call: 'ollama' (default) or 'vllm', from LLM_BACKEND."""
+    load_dotenv()
+    return os.getenv("LLM_BACKEND", "ollama").strip().lower()
+
+
+def _llm_calls(system: str, user: str):
+    """(stream, complete) zero‑arg callables for the configured LLM backend."""
+    if _llm_backend() == "vllm":
+        return (functools.partial(_vllm_stream, system, user),
+                functools.partial(_vllm_generate, system, user))
+    full_prompt = f"{system}\n\n{user}\n\nAnswer:"  # final cue
+    return (functools.partial(_ollama_stream, full_prompt),
+            functools.partial(_ollama_generate, full_prompt))
+
 
+def _generate_stream(user_prompt: str) -> Iterator[str]:
+    """Stream the completion; if streaming fails before any output, retry once without streaming."""
+    stream, complete = _llm_calls(SYSTEM_PROMPT, user_prompt)
+    emitted = False
+    try:
+        for piece in stream():
+            emitted = True
+            yield piece
+        return
+    except Exception:
+        if emitted:
+            raise
+    yield complete()
+
+
+def llm_error_message(e: Exception) -> str:
+    """User‑facing Markdown for a failed LLM call."""
+    if _llm_backend() == "vllm":
+        hint = "Check that the vLLM server is running and `VLLM_HOST`/`VLLM_MODEL` are set."
+    else:
+        hint = "Check that Ollama is running and `OLLAMA_HOST`/`OLLAMA_MODEL` are set."
+    return f"LLM call failed. {hint}\n\nError: {e}"
+
+
+def _rewrite_queries(query: str, n: int) -> List[str]:
+    """Ask the LLM for up to n paraphrases of the question; [] if the call fails."""
+    _, complete = _llm_calls(REWRITE_PROMPT.format(n=n), f"Question: {query}")
+    try:
+        text = complete()
+    except Exception:
+        return []  # retrieval falls back to the original question alone
+    # Drop list markers ("-", "*", "•", "1.", "2)") that models add despite the prompt
+    rewrites = [re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", line).strip() for line in text.splitlines()]
+    return [r for r in rewrites if r and r != query][:n]
+
+
+def _retrieve_for_answer(query: str, k: int) -> List[Tuple[str, Dict]]:
+    """retrieve(), or multi‑query retrieve_multi() when MULTI_QUERY=1."""
+    load_dotenv()
+    if os.getenv("MULTI_QUERY", "0") != "1":
+        return retrieve(query, k=k)
+    n = int(os.getenv("MULTI_QUERY_N", DEFAULT_MULTI_QUERY_N))
+    return retrieve_multi([query] + _rewrite_queries(query, n), k=k)
+
+
+def _fit_context(ctx_pairs: List[Tuple[str, Dict]], max_tokens: int) -> List[Tuple[str, Dict]]:
+    """Keep the best‑ranked chunks that fit the token budget (retrieval order is by
+    relevance). The chunk that overflows is cut at its last sentence boundary that fits.
+    """
+    budget = max(1, max_tokens) * CHARS_PER_TOKEN  # 0 / negative would send nothing or slice from the end
+    kept = []
+    for doc, meta in ctx_pairs:
+        if len(doc) <= budget:
+            kept.append((doc, meta))
+            budget -= len(doc)
+            continue
+        cuts = [m.start() for m in _SENTENCE_END.finditer(doc, 0, budget + 1)]
+        if cuts:
+            kept.append((doc[: cuts[-1]], meta))
+        elif not kept:
+            kept.append((doc[:budget], meta))  # never send an empty context
+        break
+    return kept
+
+
+def _build_prompt(query: str, ctx_pairs: List[Tuple[str, Dict]]) -> str:
+    """User turn for the LLM: format instructions, labeled context excerpts, the question.
+    Static text comes first and per‑question text last, so SYSTEM_PROMPT plus
+    ANSWER_FORMAT form an identical prefix on every turn that Ollama/vLLM can serve
+    from their prompt (KV) cache instead of recomputing.
+    """
     # Build a compact context block the model can digest.
     # Each chunk is labeled with its source filename for human‑readable citations.
     ctx_text = "\n\n---\n".join(
         [f"[From {m.get('source','unknown')}]:\n{d}" for d, m in ctx_pairs]
     )
 
-    user_prompt = (
+    return (
+        f"{ANSWER_FORMAT}\n\n"
         f"Context excerpts:\n{ctx_text}\n\n"
-        f"Question: {query}\n\n"
-        f"Answer in bullets. Then add a 'Sources' list with the file names only."
+        f"Question: {query}"
     )
 
-    full_prompt = f"{SYSTEM_PROMPT}\n\n{user_prompt}\n\nAnswer:"  # final cue
+
+def answer_stream(query: str, top_k: int = 4) -> Tuple[Iterator[str], List[Tuple[str, Dict]]]:
+    """Streaming variant of answer(): returns (iterator of Markdown fragments, ctx_pairs
+    actually sent to the model, i.e. after the MAX_CTX_TOKENS trim).
+    Retrieval happens eagerly; the LLM is only called as the iterator is consumed,
+    and it raises if the model cannot be reached (see llm_error_message).
+    """
+    ctx_pairs = _retrieve_for_answer(query, top_k)
+    ctx_pairs = _fit_context(ctx_pairs, int(os.getenv("MAX_CTX_TOKENS", DEFAULT_MAX_CTX_TOKENS)))
+    if not ctx_pairs:
+        return iter([
+            "I couldn't retrieve any context. Please run `python ingest.py` after placing your documents "
+            "under `data/docs/`, then try again."
+        ]), ctx_pairs
+    return _generate_stream(_build_prompt(query, ctx_pairs)), ctx_pairs
+
+
+def answer(query: str, top_k: int = 4) -> Tuple[str, List[Tuple[str, Dict]]]:
+    """Compose a grounded answer using retrieved context and a strict system instruction.
+    Returns (Markdown with a Sources section, the (document_text, metadata) pairs used),
+    so callers can show the excerpts without retrieving a second time.
+    """
+    pieces, ctx_pairs = answer_stream(query, top_k)
     try:
-        return _ollama_generate(full_prompt)
+        return "".join(pieces), ctx_pairs
     except Exception as e:
-        return ("LLM call failed. Check that Ollama is running and `OLLAMA_HOST`/`OLLAMA_MODEL` are set.\n\n"
-                f"Error: {e}")
\ No newline at end of file
+        return llm_error_message(e), ctx_pairs
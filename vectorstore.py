@@ -0,0 +1,33 @@
+# =============================
+# File: vectorstore.py
+# Purpose: Chroma connection shared by ingest.py (writes) and rag.py (reads).
+#          CHROMA_HOST set: talk to a Chroma server (app and ingest can run at once).
+#          Otherwise:       in-process persistent store under data/db/.
+# Notes:   Kept free of heavy imports so the app can use it without the ingest stack.
+# =============================
+
+import os
+import chromadb
+from chromadb.config import Settings
+from dotenv import load_dotenv
+
+# Using a stable collection name lets the app find it consistently
+COLLECTION_NAME = "partner_docs"
+
+
+def chroma_client():
+    """Chroma server via HttpClient when CHROMA_HOST is set, otherwise the local store."""
+    load_dotenv()
+    settings = Settings(anonymized_telemetry=False)
+    host = os.getenv("CHROMA_HOST")
+    if host:
+        return chromadb.HttpClient(host=host, port=int(os.getenv("CHROMA_PORT", "8000")), settings=settings)
+    # Persistent DB path for Chroma (lives on disk under data/db)
+    return chromadb.PersistentClient(path=os.path.join("data", "db"), settings=settings)
+
+
+def is_missing_collection(e: Exception) -> bool:
+    """True if e is Chroma saying the collection does not exist. The exception type
+    differs between Chroma versions and between local/HTTP clients; the message does not.
+    """
+    return "does not exist" in str(e)